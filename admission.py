@@ -0,0 +1,185 @@
+"""
+admission control for expensive routes
+
+app.config['ADMISSION_LIMITS'] maps endpoint names to their limits, every key optional
+
+    'api_catalog': {
+        'methods': ['GET'],       # only limit these methods (default: all)
+        'concurrency': 2,         # requests served at once by all the workers on the host
+        'queue_timeout': 0.5,     # seconds to wait for a free slot before answering 503
+        'rate': 1.0,              # token bucket refill, requests per second per client
+        'burst': 5,               # token bucket size
+    }
+
+a client is the logged in account (login_session['user_id']), or else the remote address, which is
+the X-Forwarded-For client when app.config['PROXY_COUNT'] is set. a request over its rate gets a 429
+and one that finds no free slot in time a 503, both straight away with a Retry-After header and
+before any database work. endpoints missing from the map are never limited.
+
+concurrency slots are shared by every worker process on the host: each slot is a file in
+app.config['ADMISSION_LOCK_DIR'] held with flock while a request runs (the kernel frees it if the
+worker dies). token buckets and metrics are per process, with N workers a client gets up to N * rate
+"""
+import os, time, math, fcntl, random, threading, collections
+
+from flask import request, g, jsonify
+from flask import session as login_session
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def take(self):
+        """take a token, return 0 on success or the seconds until one is available"""
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class SlotLock(object):
+    """`size` slots shared across processes, one flock'ed file per slot"""
+
+    def __init__(self, directory, name, size):
+        self.paths = [os.path.join(directory, '{0}.{1:d}.lock'.format(name, i)) for i in xrange(size)]
+
+    def try_acquire(self):
+        """take a free slot, return its open file (hand it back to release()) or None when all are taken"""
+        # start at a random slot, so concurrent requests don't all race for the first one
+        start = random.randrange(len(self.paths))
+        for path in self.paths[start:] + self.paths[:start]:
+            slot = open(path, 'a')
+            try:
+                fcntl.flock(slot.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except IOError:
+                slot.close()
+        return None
+
+    def release(self, slot):
+        fcntl.flock(slot.fileno(), fcntl.LOCK_UN)
+        slot.close()
+
+
+class AdmissionControl(object):
+    def __init__(self, app, max_clients=10000):
+        self.app = app
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._slot_locks = {}
+        self._buckets = collections.OrderedDict()
+        self._metrics = collections.defaultdict(lambda: {'admitted': 0,
+                                                         'rejected_rate': 0,
+                                                         'rejected_concurrency': 0,
+                                                         'queue_time_total_ms': 0.0,
+                                                         'queue_time_max_ms': 0.0})
+
+    def limit_for(self, endpoint, method):
+        limit = self.app.config['ADMISSION_LIMITS'].get(endpoint)
+        if limit is None or ('methods' in limit and method not in limit['methods']):
+            return None
+        return limit
+
+    def _slot_lock(self, endpoint, concurrency):
+        # keyed by size too, so a changed limit takes effect
+        key = (endpoint, concurrency)
+        with self._lock:
+            if key not in self._slot_locks:
+                directory = self.app.config['ADMISSION_LOCK_DIR']
+                if not os.path.isdir(directory):
+                    try:
+                        os.makedirs(directory)
+                    except OSError:
+                        # another worker may have just created it
+                        if not os.path.isdir(directory):
+                            raise
+                self._slot_locks[key] = SlotLock(directory, endpoint, concurrency)
+            return self._slot_locks[key]
+
+    def _take_token(self, endpoint, limit):
+        key = (endpoint, login_session.get('user_id') or request.remote_addr)
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or TokenBucket(limit['rate'], limit.get('burst', 1))
+            bucket.rate = limit['rate']
+            bucket.burst = limit.get('burst', 1)
+            # keep the most recently seen clients only
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return bucket.take()
+
+    def _acquire(self, slot_lock, timeout):
+        """return a slot of slot_lock taken within timeout seconds, or None"""
+        deadline = time.time() + timeout
+        delay = 0.001
+        slot = slot_lock.try_acquire()
+        while slot is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+            slot = slot_lock.try_acquire()
+        return slot
+
+    def _count(self, endpoint, counter, value=1):
+        with self._lock:
+            self._metrics[endpoint][counter] += value
+
+    def _reject(self, status, retry_after, message):
+        response = jsonify({'error': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
+    def before_request(self):
+        limit = self.limit_for(request.endpoint, request.method)
+        if limit is None:
+            return None
+        endpoint = request.endpoint
+        if 'rate' in limit:
+            wait = self._take_token(endpoint, limit)
+            if wait:
+                self._count(endpoint, 'rejected_rate')
+                return self._reject(429, wait, 'too many requests, slow down')
+        if 'concurrency' in limit:
+            slot_lock = self._slot_lock(endpoint, limit['concurrency'])
+            start = time.time()
+            slot = self._acquire(slot_lock, limit.get('queue_timeout', 0))
+            queued_ms = (time.time() - start) * 1000
+            with self._lock:
+                metrics = self._metrics[endpoint]
+                metrics['queue_time_total_ms'] += queued_ms
+                metrics['queue_time_max_ms'] = max(metrics['queue_time_max_ms'], queued_ms)
+            if slot is None:
+                self._count(endpoint, 'rejected_concurrency')
+                return self._reject(503, 1, 'server busy, try again shortly')
+            g.admission_slot = (slot_lock, slot)
+        self._count(endpoint, 'admitted')
+        return None
+
+    def teardown_request(self, exception=None):
+        held = g.pop('admission_slot', None)
+        if held is not None:
+            slot_lock, slot = held
+            slot_lock.release(slot)
+
+    def metrics(self):
+        """return {endpoint: counters} for the endpoints seen by this process"""
+        with self._lock:
+            return dict((endpoint, dict(counters)) for endpoint, counters in self._metrics.items())
+
+
+def install(app):
+    """enforce app.config['ADMISSION_LIMITS'] on every request to app, return the AdmissionControl"""
+    control = AdmissionControl(app)
+    app.before_request(control.before_request)
+    app.teardown_request(control.teardown_request)
+    return control
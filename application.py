@@ -1,14 +1,20 @@
 from functools import wraps
 from datetime import datetime
 from urlparse import urljoin
-import re, collections, os, random, string, json, httplib2
+import re, collections, os, json, tempfile, httplib2
 
 # flask related imports
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
 from flask import session as login_session
-from flask import make_response
+from flask import make_response, g, has_request_context
 from werkzeug.contrib.atom import AtomFeed
 from werkzeug.utils import secure_filename
+from werkzeug.contrib.fixers import ProxyFix
+from session_store import ServerSessionInterface
+import csrf
+from profiling import ProfilerMiddleware, profile_token, list_profiles
+import query_guard
+import admission
 
 # jinja2 related
 from jinja2 import evalcontextfilter, Markup, escape
@@ -16,15 +22,28 @@ from jinja2 import evalcontextfilter, Markup, escape
 _paragraph_re = re.compile(r'(?:\r\n|\r|\n){2,}')
 
 # database related imports
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Category, Subcategory, Item, ItemImage, User
+from sqlalchemy import create_engine, event, inspect, func, asc, desc
+from sqlalchemy.orm import sessionmaker, scoped_session, joinedload, Session
+from sqlalchemy.pool import QueuePool
+from database_setup import Base, Category, Subcategory, Item, ItemImage, User, Change
 
-# connect to Database and create database session
-engine = create_engine('sqlite:///catalog.db')
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-db_session = DBSession()
+# primary (read / write) and read-only engines, created lazily by init_db()
+engine = None
+read_engine = None
+_engine_pid = None
+
+
+class RoutingSession(Session):
+    """session sending the queries of read-only requests to read_engine and everything else to engine"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and read_engine is not None and has_request_context() and g.get('read_only'):
+            return read_engine
+        return engine
+
+
+DBSession = sessionmaker(class_=RoutingSession)
+db_session = scoped_session(DBSession)
 
 # OAuth2 related imports
 from oauth2client.client import flow_from_clientsecrets
@@ -40,6 +59,63 @@ UPLOAD_DIR = os.path.join(ROOT_DIR, 'uploads')
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
 app.config['UPLOAD_FOLDER'] = UPLOAD_DIR
 
+# configure database
+#   DATABASE_READ_URI   engine for GET / HEAD requests, a replica on server databases. defaults to
+#                       DATABASE_URI, opened with read-only tuned connections when that is sqlite
+#   DATABASE_READ_ROUTING  set CATALOG_READ_ROUTING=0 to send every query to the primary engine
+app.config['DATABASE_URI'] = os.environ.get('CATALOG_DATABASE_URI', 'sqlite:///catalog.db')
+app.config['DATABASE_READ_URI'] = os.environ.get('CATALOG_DATABASE_READ_URI')
+app.config['DATABASE_READ_ROUTING'] = os.environ.get('CATALOG_READ_ROUTING', '1') != '0'
+app.config['DATABASE_POOL_SIZE'] = 2
+app.config['DATABASE_READ_POOL_SIZE'] = 8
+app.config['SQLITE_READ_CACHE_KB'] = 64 * 1024
+app.config['SQLITE_READ_MMAP_BYTES'] = 256 * 1024 * 1024
+
+# configure session storage: 'cookie' (flask's signed cookie), 'memory' or 'sqlite' (see session_store.py)
+app.config['SESSION_BACKEND'] = os.environ.get('CATALOG_SESSION_BACKEND', 'cookie')
+app.config['SESSION_SQLITE_PATH'] = os.path.join(ROOT_DIR, 'sessions.db')
+app.config['SESSION_MEMORY_MAX_ENTRIES'] = 10000
+if app.config['SESSION_BACKEND'] != 'cookie':
+    app.session_interface = ServerSessionInterface.from_config(app)
+
+# configure CSRF tokens, seconds a form stays valid after it was rendered
+app.config['CSRF_TIME_LIMIT'] = 3600
+
+# configure request profiling (see profiling.py), off unless a request carries a profile token
+app.config['PROFILE_DIR'] = os.path.join(ROOT_DIR, 'profiles')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('CATALOG_PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_MAX_FILES'] = 200
+app.config['PROFILE_TOKEN_TIME_LIMIT'] = 3600
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app)
+
+# configure N+1 detection (see query_guard.py), max times a request may run the same SELECT
+app.config['QUERY_REPEAT_THRESHOLD'] = 2
+query_guard.install(app)
+
+# configure admission control (see admission.py), per endpoint concurrency slots shared by the
+# workers on the host and per client token buckets for the expensive routes. CATALOG_ADMISSION=0
+# turns every limit off
+app.config['ADMISSION_LOCK_DIR'] = os.environ.get('CATALOG_ADMISSION_LOCK_DIR', os.path.join(ROOT_DIR, 'admission'))
+app.config['ADMISSION_LIMITS'] = {} if os.environ.get('CATALOG_ADMISSION') == '0' else {
+    'api_catalog': {'concurrency': 2, 'queue_timeout': 1, 'rate': 1, 'burst': 10},
+    'recent_feed': {'concurrency': 4, 'queue_timeout': 0.5, 'rate': 2, 'burst': 20},
+    'api_changes': {'concurrency': 4, 'queue_timeout': 0.5, 'rate': 5, 'burst': 20},
+    'api_subcategories_batch': {'rate': 5, 'burst': 20},
+    'new_item': {'methods': ['POST'], 'concurrency': 2, 'queue_timeout': 2, 'rate': 0.5, 'burst': 5},
+    'edit_item': {'methods': ['POST'], 'concurrency': 2, 'queue_timeout': 2, 'rate': 0.5, 'burst': 5},
+    'batch_items': {'methods': ['POST'], 'concurrency': 1, 'queue_timeout': 2, 'rate': 0.2, 'burst': 3},
+    'login': {'methods': ['POST'], 'rate': 0.2, 'burst': 5},
+    'google_connect': {'rate': 0.2, 'burst': 5},
+}
+admission_control = admission.install(app)
+
+# configure reverse proxies, when serving behind nginx / a CDN set CATALOG_PROXY_COUNT to the number of
+# proxies in front of the app, so request.remote_addr (and the admission buckets) is the real client
+# taken from X-Forwarded-For. leave it at 0 when clients connect directly, or they could forge it
+app.config['PROXY_COUNT'] = int(os.environ.get('CATALOG_PROXY_COUNT', 0))
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['PROXY_COUNT'])
+
 # configure google OAuth
 CLIENT_ID = json.loads(open('client_secrets.json', 'r').read())['web']['client_id']
 
@@ -48,6 +124,139 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
 
 
+def _create_engine(uri, pool_size, read_only=False):
+    """
+    create an engine with its own connection pool
+
+    sqlite connections run in WAL mode, so readers are not blocked by a writer, and read-only ones
+    get query_only plus a larger page cache and mmap
+    """
+    if not uri.startswith('sqlite'):
+        return create_engine(uri, pool_size=pool_size, max_overflow=pool_size)
+    new_engine = create_engine(uri, poolclass=QueuePool, pool_size=pool_size, max_overflow=pool_size,
+                               connect_args={'check_same_thread': False})
+
+    @event.listens_for(new_engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+            cursor.execute('PRAGMA cache_size=-{0:d}'.format(app.config['SQLITE_READ_CACHE_KB']))
+            cursor.execute('PRAGMA mmap_size={0:d}'.format(app.config['SQLITE_READ_MMAP_BYTES']))
+        else:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    return new_engine
+
+
+def init_db():
+    """
+    return the primary engine owned by the current process, creating it (and the read engine) on first use
+
+    the engines are re-created whenever the pid changes, so pre-forked workers (see wsgi.py)
+    never share sqlite handles with the master or with each other
+    """
+    global engine, read_engine, _engine_pid
+    if engine is not None and _engine_pid == os.getpid() and str(engine.url) == app.config['DATABASE_URI']:
+        return engine
+    engine = _create_engine(app.config['DATABASE_URI'], app.config['DATABASE_POOL_SIZE'])
+    # connect once so the primary switches the file to WAL before any reader opens it
+    engine.connect().close()
+    # databases created before a table was added (e.g. the change log) get it here, existing tables are left alone
+    Base.metadata.create_all(engine)
+    read_engine = None
+    if app.config['DATABASE_READ_ROUTING']:
+        read_engine = _create_engine(app.config['DATABASE_READ_URI'] or app.config['DATABASE_URI'],
+                                     app.config['DATABASE_READ_POOL_SIZE'], read_only=True)
+    _engine_pid = os.getpid()
+    Base.metadata.bind = engine
+    DBSession.configure(bind=engine)
+    db_session.remove()
+    return engine
+
+
+def dispose_db():
+    """close the pooled connections of this process' engines"""
+    for e in (engine, read_engine):
+        if e is not None:
+            e.dispose()
+
+
+# entities recorded in the change log
+CHANGE_TRACKED = (Category, Subcategory, Item, ItemImage)
+
+
+def _change_data(obj):
+    """return every loaded column of obj as JSON, read from its state so deleted rows emit no SQL"""
+    loaded = inspect(obj).dict
+    data = {}
+    for column in obj.__table__.columns:
+        value = loaded.get(column.key)
+        data[column.name] = value.isoformat() if isinstance(value, datetime) else value
+    return json.dumps(data)
+
+
+@event.listens_for(DBSession, 'after_flush')
+def record_changes(session, flush_context):
+    """collect a change for every tracked entity created, updated or deleted by this flush"""
+    pending = session.info.setdefault('changes', collections.OrderedDict())
+    now = datetime.now()
+    for action, objects in (('create', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        objects = [obj for obj in objects if isinstance(obj, CHANGE_TRACKED)]
+        # the session's collections are unordered, log parents before children and rows by id
+        objects.sort(key=lambda obj: (CHANGE_TRACKED.index(type(obj)), obj.id))
+        for obj in objects:
+            if action == 'update' and not session.is_modified(obj, include_collections=False):
+                continue
+            key = (obj.__tablename__, obj.id)
+            previous = pending.get(key)
+            # a transaction flushes as often as it autoflushes, keep one change per row with its
+            # final data: created then updated is a create, created then deleted never existed
+            entry_action = action
+            if previous is not None and previous['action'] == 'create':
+                if action == 'delete':
+                    del pending[key]
+                    continue
+                entry_action = 'create'
+            pending[key] = {'entity': obj.__tablename__,
+                            'entity_id': obj.id,
+                            'action': entry_action,
+                            'data': _change_data(obj),
+                            'changed': now}
+
+
+@event.listens_for(DBSession, 'before_commit')
+def write_changes(session):
+    """append the changes collected by this transaction's flushes to the change log"""
+    # commit flushes after this hook, flush now so the last changes are collected too
+    session.flush()
+    pending = session.info.pop('changes', None)
+    if pending:
+        # written through the transaction's connection, so the log commits with the change itself
+        session.connection().execute(Change.__table__.insert(), pending.values())
+
+
+@event.listens_for(DBSession, 'after_transaction_end')
+def discard_changes(session, transaction):
+    """forget the changes of a transaction that was rolled back or closed instead of committed"""
+    if transaction.parent is None:
+        session.info.pop('changes', None)
+
+
+@app.before_request
+def before_request():
+    init_db()
+    # GET / HEAD routes only read, so their queries can go to the read engine
+    g.read_only = request.method in ('GET', 'HEAD')
+
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    db_session.remove()
+
+
 #  ------------------------------  jinja2 ------------------------------
 
 
@@ -135,8 +344,12 @@ def list_item(category):
 
 
 def list_latest_item(limit):
-    """return list of latest items within given limit"""
-    return db_session.query(Item).order_by(desc(Item.added)).limit(limit).all()
+    """return list of latest items within given limit, with their categories loaded"""
+    return (db_session.query(Item)
+            .options(joinedload(Item.category))
+            .order_by(desc(Item.added))
+            .limit(limit)
+            .all())
 
 
 def list_item_image():
@@ -144,6 +357,112 @@ def list_item_image():
     return db_session.query(ItemImage).order_by(asc(ItemImage.item_id)).all()
 
 
+def list_item_image_in(items):
+    """return list of images belonging to the items of given item query, in one query"""
+    return (db_session.query(ItemImage)
+            .filter(ItemImage.item_id.in_(items.with_entities(Item.id)))
+            .all())
+
+
+def catalog_version():
+    """return the latest change log cursor, it moves whenever the catalog is written"""
+    return db_session.query(func.max(Change.id)).scalar() or 0
+
+
+# (catalog version, map) of the last subcategory_map() build
+_subcategory_map_cache = (None, None)
+
+
+def subcategory_map():
+    """
+    return (version, {category id: [serialized subcategory, ...]}) for every category
+
+    built with a single query and kept per process until the catalog version changes
+    """
+    global _subcategory_map_cache
+    version = catalog_version()
+    if _subcategory_map_cache[0] != version:
+        mapping = collections.defaultdict(list)
+        for subcategory in db_session.query(Subcategory).order_by(asc(Subcategory.id)):
+            mapping[subcategory.category_id].append(subcategory.serialize)
+        _subcategory_map_cache = (version, dict(mapping))
+    return _subcategory_map_cache
+
+
+#  ------------------------------  upload helpers ------------------------------
+
+
+def remove_upload(filename):
+    """delete an uploaded file, a file that is already gone is not an error"""
+    try:
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    except OSError:
+        pass
+
+
+class UploadTransaction(object):
+    """
+    commits the db session together with file uploads
+
+        with UploadTransaction() as uploads:
+            filename = uploads.stage(image_file, item.id)
+            uploads.remove(old_image.filename)
+            ...
+
+    uploads are written to temp files inside the upload folder while the transaction is open.
+    only after the commit succeeds are they renamed (atomically) to their final name and the
+    replaced files deleted. on any error the session is rolled back and the temp files removed,
+    so a failed write never leaves orphan files or dangling image rows behind
+    """
+
+    def __init__(self):
+        self.staged = []
+        self.removed = []
+
+    def stage(self, image_file, item_id):
+        """save image_file to a temp file, return the filename it will have once committed"""
+        filename = "{0}-{1}".format(item_id, secure_filename(image_file.filename))
+        fd, temp_path = tempfile.mkstemp(prefix='.staged-', dir=app.config['UPLOAD_FOLDER'])
+        self.staged.append((filename, temp_path))
+        os.chmod(temp_path, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            image_file.save(f)
+        return filename
+
+    def remove(self, filename):
+        """delete filename once the transaction is committed"""
+        self.removed.append(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                db_session.commit()
+            except Exception:
+                self._abort()
+                raise
+            staged_filenames = set()
+            for filename, temp_path in self.staged:
+                os.rename(temp_path, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                staged_filenames.add(filename)
+            for filename in self.removed:
+                if filename not in staged_filenames:
+                    remove_upload(filename)
+        else:
+            self._abort()
+        return False
+
+    def _abort(self):
+        db_session.rollback()
+        for filename, temp_path in self.staged:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
 #  ------------------------------  decorators ------------------------------
 
 
@@ -214,17 +533,27 @@ def item_required(f):
 
 
 # prevent_CSRF
+@app.template_global()
+def csrf_token(scope):
+    """return a CSRF token for forms posting to the given endpoint"""
+    if 'csrf_key' not in login_session:
+        login_session['csrf_key'] = csrf.new_session_key()
+    return csrf.generate_token(app.secret_key, login_session['csrf_key'], scope)
+
+
+def valid_csrf_token(scope, token):
+    """return True if token was issued by csrf_token(scope) to this session and has not expired"""
+    return csrf.validate_token(app.secret_key, login_session.get('csrf_key'), scope, token,
+                               app.config['CSRF_TIME_LIMIT'])
+
+
 def prevent_CSRF(f):
     @wraps(f)
     def wrap(*args, **kwargs):
         if request.method == 'GET':
-            state = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in xrange(32))
-            login_session['state'] = state
-            kwargs['state'] = state
+            kwargs['state'] = csrf_token(request.endpoint)
         if request.method == 'POST':
-            state = request.form.get('state', '')
-            session_state = login_session.get('state', None)
-            if session_state != state:
+            if not valid_csrf_token(request.endpoint, request.form.get('state', '')):
                 flash('invalid post, possible due to Cross-Site Request Forgery (CSRF)')
                 return redirect(url_for('home'))
         return f(*args, **kwargs)
@@ -248,21 +577,25 @@ def home():
 
 @app.route("/catalog.json")
 def api_catalog():
-    """
-    return entire catalog data set in JSON format
-    notes:
-        current implementation is inefficient due to nested db query calls
-        with better understanding of SQLAlchemy or some sort of magical join
-        could probably reduce db queries down to 1 or 2
-    """
+    """return entire catalog data set in JSON format"""
+    # one query per table, grouped in python, instead of a query per category and per subcategory
+    subcategories = collections.defaultdict(list)
+    for sub_cat in db_session.query(Subcategory).order_by(asc(Subcategory.id)):
+        subcategories[sub_cat.category_id].append(sub_cat)
+    subcategory_items = collections.defaultdict(list)
+    non_subcategory_items = collections.defaultdict(list)
+    for item in db_session.query(Item).order_by(asc(Item.id)):
+        if item.subcategory_id is None:
+            non_subcategory_items[item.category_id].append(item.serialize)
+        else:
+            subcategory_items[item.subcategory_id].append(item.serialize)
     catalog = []
     for cat in list_category():
         category = {'category': cat.serialize, 'subcategories': [], 'items': []}
-        for sub_cat in list_subcategory(cat):
-            sub_cat_items = list_subcategory_item(sub_cat)
+        for sub_cat in subcategories[cat.id]:
             category['subcategories'].append({'subcategory': sub_cat.serialize,
-                                              'items': [i.serialize for i in sub_cat_items]})
-        category['items'] = [i.serialize for i in list_non_subcategory_item(cat)]
+                                              'items': subcategory_items[sub_cat.id]})
+        category['items'] = non_subcategory_items[cat.id]
         catalog.append(category)
     return jsonify({"catalog": catalog, "item_images": [i.serialize for i in list_item_image()]})
 
@@ -283,6 +616,34 @@ def recent_feed():
     return feed.get_response()
 
 
+@app.route('/changes')
+def api_changes():
+    """
+    returns catalog changes after the given cursor in JSON format
+
+        /changes?since=<cursor>&limit=<n>
+
+    consumers keep the returned cursor and pass it as `since` on the next call, while has_more is
+    true there are more changes to fetch right away. a transaction logs one entry per row it wrote,
+    carrying the row's committed data (its last known data for deletes)
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({'error': 'since and limit must be integers'}), 400
+    changes = (db_session.query(Change)
+               .filter(Change.id > since)
+               .order_by(asc(Change.id))
+               .limit(limit + 1)
+               .all())
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return jsonify({'changes': [c.serialize for c in changes],
+                    'cursor': changes[-1].id if changes else since,
+                    'has_more': has_more})
+
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
@@ -291,6 +652,12 @@ def uploaded_file(filename):
 #  ------------------------------  login / logout ------------------------------
 
 
+def regenerate_session():
+    """give a server-side session a new id, so an id planted before login never becomes authenticated"""
+    if hasattr(login_session, 'regenerate'):
+        login_session.regenerate()
+
+
 @app.route("/login", methods=['POST', 'GET'])
 @prevent_CSRF
 def login(state=None):
@@ -299,7 +666,9 @@ def login(state=None):
         if request.form['username'] != 'admin' or request.form['password'] != 'admin':
             error = 'invalid credential, please try again'
         else:
+            regenerate_session()
             login_session['user'] = 'admin'
+            login_session['user_id'] = 'local:admin'
             flash('You are now logged in')
             return redirect(url_for('home'))
     return render_template('login.html', error=error, state=state)
@@ -325,6 +694,7 @@ def logout():
             else:
                 print 'Current user not connected to google'
     login_session.pop('user', None)
+    login_session.pop('user_id', None)
     flash('You are now logged out')
     return redirect(url_for('home'))
 
@@ -332,7 +702,7 @@ def logout():
 @app.route('/google_connect', methods=['POST'])
 def google_connect():
     # Validate state token
-    if request.args.get('state') != login_session['state']:
+    if not valid_csrf_token('google_connect', request.args.get('state')):
         response = make_response(json.dumps('Invalid state parameter.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
@@ -405,7 +775,10 @@ def google_connect():
         db_session.commit()
 
     # save to session
+    regenerate_session()
     login_session['user'] = user_info['name']
+    # the name is only for display, two accounts may share it
+    login_session['user_id'] = 'google:' + gplus_id
     login_session['user_type'] = 'google'
 
     flash("you are now logged in as %s" % user_info['name'])
@@ -493,17 +866,16 @@ def edit_category(category_id=None, category_name=None, category=None, state=Non
 @category_required
 @prevent_CSRF
 def delete_category(category_id=None, category_name=None, category=None, state=None):
-    db_session.delete(category)
-    for subcategory in list_subcategory(category):
-        db_session.delete(subcategory)
-    for item in list_item(category):
-        db_session.delete(item)
-        item_image = get_item_image(item)
-        if item_image:
-            # delete item's image record and image file as well
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], item_image.filename))
+    with UploadTransaction() as uploads:
+        # delete item's image record and image file as well, the file only once the delete is committed
+        for item_image in list_item_image_in(list_item(category)):
+            uploads.remove(item_image.filename)
             db_session.delete(item_image)
-    db_session.commit()
+        db_session.delete(category)
+        for subcategory in list_subcategory(category):
+            db_session.delete(subcategory)
+        for item in list_item(category):
+            db_session.delete(item)
     flash('Category {0} deleted!'.format(category_name))
     return redirect(url_for('home'))
 
@@ -514,13 +886,33 @@ def delete_category(category_id=None, category_name=None, category=None, state=N
 @app.route("/category/<int:category_id>/<path:category_name>/subcategories.json")
 @category_required
 def api_subcategories(category_id=None, category_name=None, category=None):
+    """returns list of subcategories for given category in JSON format"""
+    version, mapping = subcategory_map()
+    return jsonify({"subcategories": mapping.get(category.id, [])})
+
+
+@app.route("/subcategories.json")
+def api_subcategories_batch():
     """
-    returns list of subcategories for given category in JSON format
+    returns subcategories of several categories at once in JSON format
+
+        /subcategories.json?category_ids=1,2,3   (all categories when category_ids is omitted)
 
-    this method is primary used by new/edit item form for ajax loading subcategory list
+    the response carries the catalog version as ETag, so clients can revalidate for free
     """
-    subcategories = list_subcategory(category)
-    return jsonify({"subcategories": [i.serialize for i in subcategories]})
+    version, mapping = subcategory_map()
+    category_ids = request.args.get('category_ids')
+    if category_ids is not None:
+        try:
+            category_ids = [int(i) for i in category_ids.split(',') if i.strip()]
+        except ValueError:
+            return jsonify({'error': 'category_ids must be a comma separated list of integers'}), 400
+        mapping = dict((i, mapping.get(i, [])) for i in category_ids)
+    response = jsonify({"version": version, "subcategories": mapping})
+    response.set_etag('{0}-{1}'.format(version, request.args.get('category_ids', 'all')))
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route('/category/<int:category_id>/<path:category_name>/subcategory/new', methods=['POST', 'GET'])
@@ -589,16 +981,15 @@ def edit_subcategory(category_id=None, category_name=None, category=None, subcat
 @prevent_CSRF
 def delete_subcategory(category_id=None, category_name=None, category=None, subcategory_id=None,
                        subcategory_name=None, subcategory=None, state=None):
-    db_session.delete(subcategory)
-    for item in list_subcategory_item(subcategory):
-        # delete all the items under this subcategory
-        db_session.delete(item)
-        item_image = get_item_image(item)
-        if item_image:
-            # delete item's image record and image file as well
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], item_image.filename))
+    with UploadTransaction() as uploads:
+        # delete item's image record and image file as well, the file only once the delete is committed
+        for item_image in list_item_image_in(list_subcategory_item(subcategory)):
+            uploads.remove(item_image.filename)
             db_session.delete(item_image)
-    db_session.commit()
+        db_session.delete(subcategory)
+        for item in list_subcategory_item(subcategory):
+            # delete all the items under this subcategory
+            db_session.delete(item)
     flash('Subcategory {0} deleted!'.format(subcategory_name))
     return redirect(url_for('show_category', category_id=category.id, category_name=category.name))
 
@@ -657,14 +1048,13 @@ def new_item(state=None):
                         category_id=category.id)
             if subcategory:
                 item.subcategory_id = subcategory.id
-            db_session.add(item)
-            db_session.commit()
-            if image_file and allowed_file(image_file.filename):
-                filename = "{0}-{1}".format(item.id, secure_filename(image_file.filename))
-                image_file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                image = ItemImage(item_id=item.id, filename=filename)
-                db_session.add(image)
-                db_session.commit()
+            with UploadTransaction() as uploads:
+                db_session.add(item)
+                if image_file and allowed_file(image_file.filename):
+                    # flush to get the item id for the image's filename, still within the same transaction
+                    db_session.flush()
+                    image = ItemImage(item_id=item.id, filename=uploads.stage(image_file, item.id))
+                    db_session.add(image)
             flash('New item %s successfully created' % name)
             return redirect(url_for('show_item', category_id=item.category.id, category_name=item.category.name,
                                     item_id=item.id, item_name=item.name))
@@ -681,6 +1071,7 @@ def new_item(state=None):
                            subcategories=subcategories,
                            subcategory_id=subcategory_id,
                            catalog=catalog,
+                           subcategory_map=subcategory_map()[1],
                            item_image=None,
                            state=state,
                            edit_or_add="Add")
@@ -725,22 +1116,17 @@ def edit_item(item_id=None, item_name=None, item=None, state=None):
                 else:
                     item.subcategory_id = None
         if not error:
-            db_session.add(item)
-            db_session.commit()
-            if image_file and allowed_file(image_file.filename):
-                filename = "{0}-{1}".format(item.id, secure_filename(image_file.filename))
-                image_file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                if item_image:
-                    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], item_image.filename))
-                    db_session.delete(item_image)
-                image = ItemImage(item_id=item.id, filename=filename)
-                db_session.add(image)
-                db_session.commit()
-            else:
-                if 'delete' in delete_image:
-                    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], item_image.filename))
+            with UploadTransaction() as uploads:
+                db_session.add(item)
+                if image_file and allowed_file(image_file.filename):
+                    if item_image:
+                        uploads.remove(item_image.filename)
+                        db_session.delete(item_image)
+                    image = ItemImage(item_id=item.id, filename=uploads.stage(image_file, item.id))
+                    db_session.add(image)
+                elif 'delete' in delete_image and item_image:
+                    uploads.remove(item_image.filename)
                     db_session.delete(item_image)
-                    db_session.commit()
             flash('item {0} updated!'.format(item_name))
             return redirect(url_for('show_item', category_id=item.category.id, category_name=item.category.name,
                                     item_id=item.id, item_name=item.name))
@@ -753,6 +1139,7 @@ def edit_item(item_id=None, item_name=None, item=None, state=None):
                            subcategory_id=subcategory_id,
                            subcategories=subcategories,
                            catalog=catalog,
+                           subcategory_map=subcategory_map()[1],
                            item_image=item_image,
                            state=state,
                            item=item,
@@ -766,17 +1153,114 @@ def edit_item(item_id=None, item_name=None, item=None, state=None):
 def delete_item(item_id=None, item_name=None, item=None, state=None):
     category_name = item.category.name
     category_id = item.category.id
-    db_session.delete(item)
-    item_image = get_item_image(item)
-    if item_image:
-        # delete item's image record and image file as well
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], item_image.filename))
-        db_session.delete(item_image)
-    db_session.commit()
+    with UploadTransaction() as uploads:
+        item_image = get_item_image(item)
+        if item_image:
+            # delete item's image record and image file as well, the file only once the delete is committed
+            uploads.remove(item_image.filename)
+            db_session.delete(item_image)
+        db_session.delete(item)
     flash('Item {0} deleted!'.format(item_name))
     return redirect(url_for('show_category', category_id=category_id, category_name=category_name))
 
 
+@app.route("/items/batch", methods=['POST', 'GET'])
+@login_required
+@prevent_CSRF
+def batch_items(state=None):
+    """
+    creates many items in a single transaction
+
+    GET returns the CSRF state to post back. POST takes a multipart form with
+        state       the CSRF state
+        items       JSON list of {"name", "description", "category", "subcategory"}
+        image-<n>   optional image for the n-th item
+    either every item is created (201, JSON list of the new items) or none is (400, JSON list of errors)
+    """
+    if request.method == 'GET':
+        return jsonify({'state': state})
+    try:
+        entries = json.loads(request.form.get('items', ''))
+    except ValueError:
+        entries = None
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'errors': ['items must be a non-empty JSON list']}), 400
+    # look up every category / subcategory once instead of per item
+    categories = dict((str(c.id), c) for c in list_category())
+    subcategories = dict((str(s.id), s) for s in db_session.query(Subcategory))
+    errors = []
+    items = []
+    now = datetime.now()
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            errors.append('item {0}: not a JSON object'.format(index))
+            continue
+        name = unicode(entry.get('name') or '').strip()
+        category_id = unicode(entry.get('category') or '').strip()
+        subcategory_id = unicode(entry.get('subcategory') or '').strip()
+        if not name:
+            errors.append('item {0}: item name is missing'.format(index))
+        elif not category_id:
+            errors.append('item {0}: category is missing'.format(index))
+        elif category_id not in categories:
+            errors.append('item {0}: category is not found'.format(index))
+        elif subcategory_id and subcategory_id not in subcategories:
+            errors.append('item {0}: subcategory is not found'.format(index))
+        else:
+            items.append(Item(name=name,
+                              description=unicode(entry.get('description') or '').strip(),
+                              added=now,
+                              updated=now,
+                              category_id=categories[category_id].id,
+                              subcategory_id=subcategories[subcategory_id].id if subcategory_id else None))
+    if errors:
+        return jsonify({'errors': errors}), 400
+    with UploadTransaction() as uploads:
+        db_session.add_all(items)
+        db_session.flush()
+        for index, item in enumerate(items):
+            image_file = request.files.get('image-{0}'.format(index))
+            if image_file and allowed_file(image_file.filename):
+                db_session.add(ItemImage(item_id=item.id, filename=uploads.stage(image_file, item.id)))
+        # serialize before the commit expires the items, to avoid reloading each one
+        created = [i.serialize for i in items]
+    return jsonify({'items': created}), 201
+
+
+#  ------------------------------  admin ------------------------------
+
+
+@app.route("/admin/profiles")
+@login_required
+def admin_profiles():
+    """
+    returns the most expensive recently profiled requests in JSON format
+
+    also hands out a profile token: send it as the X-Profile header (or _profile query arg)
+    to have a request profiled
+    """
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        limit = 20
+    return jsonify({'token': profile_token(app),
+                    'profiles': list_profiles(app.config['PROFILE_DIR'], limit=limit)})
+
+
+@app.route("/admin/metrics")
+@login_required
+def admin_metrics():
+    """returns admission control counters (admitted / rejected requests, queue times) of this process"""
+    return jsonify({'admission': admission_control.metrics()})
+
+
+@app.route("/admin/profiles/<path:filename>")
+@login_required
+def admin_profile_file(filename):
+    """download a pstats dump"""
+    return send_from_directory(app.config['PROFILE_DIR'], filename, as_attachment=True)
+
+
 if __name__ == "__main__":
     app.debug = True
     app.run(host="0.0.0.0", port=8000)
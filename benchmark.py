@@ -0,0 +1,172 @@
+"""
+benchmark suite
+
+    python benchmark.py servers [requests] [concurrency]
+
+servers: starts the dev server (`python application.py`) and the production launcher
+(gunicorn + wsgi.py) one after the other and fires the same GET mix at both
+csrf: issue + validate cost of the old session-stored random state vs. the signed tokens in csrf.py
+readwrite: GET throughput while writers keep posting item batches, with and without read/write
+routing (CATALOG_READ_ROUTING), against a throwaway copy of catalog.db
+"""
+import os, re, sys, time, json, shutil, tempfile, threading, subprocess, signal, timeit
+
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+GUNICORN = [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()']
+PATHS = ['/', '/catalog.json', '/recent.atom', '/category/1/Anaesthetics']
+
+
+def wait_until_up(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(base_url + '/', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError('server at {0} did not come up'.format(base_url))
+
+
+def load(base_url, total, concurrency, paths=PATHS):
+    """fire `total` GETs over `concurrency` threads, return list of latencies in seconds"""
+    latencies = []
+    lock = threading.Lock()
+    counter = [0]
+
+    def worker():
+        http = requests.Session()
+        while True:
+            with lock:
+                if counter[0] >= total:
+                    return
+                path = paths[counter[0] % len(paths)]
+                counter[0] += 1
+            start = time.time()
+            http.get(base_url + path)
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    print '{0:<24} {1:>8.1f} req/s   mean {2:>7.2f} ms   p95 {3:>7.2f} ms'.format(
+        name,
+        len(latencies) / elapsed,
+        1000 * sum(latencies) / len(latencies),
+        1000 * latencies[int(len(latencies) * 0.95) - 1])
+
+
+def run_server(name, cmd, port, total, concurrency, env=None, background=None, paths=PATHS):
+    """start a server, run the GET load against it (and `background(base_url, stop)` alongside), report"""
+    proc = subprocess.Popen(cmd, cwd=ROOT_DIR, env=env, preexec_fn=os.setsid,
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    base_url = 'http://127.0.0.1:{0}'.format(port)
+    stop = threading.Event()
+    try:
+        wait_until_up(base_url)
+        if background:
+            threading.Thread(target=background, args=(base_url, stop)).start()
+        start = time.time()
+        latencies = load(base_url, total, concurrency, paths)
+        report(name, latencies, time.time() - start)
+    finally:
+        stop.set()
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait()
+
+
+def bench_servers(total=2000, concurrency=8):
+    """dev server vs. pre-forked gunicorn workers"""
+    # admission control would shed most of a single client's load, measure the servers themselves
+    env = dict(os.environ, CATALOG_ADMISSION='0')
+    run_server('dev server', [sys.executable, 'application.py'], 8000, total, concurrency, env=env)
+    env = dict(env, CATALOG_BIND='127.0.0.1:8001')
+    run_server('gunicorn (wsgi.py)', GUNICORN + ['-c', 'gunicorn_conf.py', 'wsgi:application'],
+               8001, total, concurrency, env=env)
+
+
+def bench_csrf(number=100000):
+    """per form page cost of issuing and checking a CSRF token"""
+    setup = """
+import random, string, csrf
+from flask.sessions import SecureCookieSession
+secret = 'benchmark secret'
+session = SecureCookieSession({'csrf_key': csrf.new_session_key()})
+
+def legacy():
+    # what prevent_CSRF used to do: python-level loop over `random` + a session write per form GET
+    state = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in xrange(32))
+    session['state'] = state
+    return session.get('state') == state
+
+def signed():
+    token = csrf.generate_token(secret, session['csrf_key'], 'edit_item')
+    return csrf.validate_token(secret, session['csrf_key'], 'edit_item', token, 3600)
+"""
+    for name in ('legacy', 'signed'):
+        elapsed = timeit.timeit(name + '()', setup=setup, number=number)
+        print '{0:<24} {1:>8.2f} us/form'.format(name, 1e6 * elapsed / number)
+
+
+def write_items(base_url, stop, batch=5, pause=0.05):
+    """log in and keep posting batches of items, `pause` seconds apart, until stop is set"""
+    http = requests.Session()
+    rv = http.get(base_url + '/login')
+    state = re.search(r'name="state" value="([^"]+)"', rv.text).group(1)
+    http.post(base_url + '/login', data={'username': 'admin', 'password': 'admin', 'state': state})
+    items = json.dumps([{'name': 'benchmark item', 'category': 1}] * batch)
+    while not stop.is_set():
+        state = http.get(base_url + '/items/batch').json()['state']
+        http.post(base_url + '/items/batch', data={'state': state, 'items': items})
+        stop.wait(pause)
+
+
+def bench_readwrite(total=2000, concurrency=8, writers=2):
+    """reads under a concurrent write mix, primary-only vs. routed to the read engine"""
+    for routing in ('0', '1'):
+        tmp_dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(ROOT_DIR, 'catalog.db'), tmp_dir)
+        env = dict(os.environ,
+                   CATALOG_BIND='127.0.0.1:8002',
+                   CATALOG_WORKERS='2',
+                   CATALOG_THREADS='4',
+                   CATALOG_READ_ROUTING=routing,
+                   CATALOG_ADMISSION='0',
+                   CATALOG_DATABASE_URI='sqlite:///' + os.path.join(tmp_dir, 'catalog.db'))
+
+        def background(base_url, stop):
+            for _ in xrange(writers):
+                writer = threading.Thread(target=write_items, args=(base_url, stop))
+                writer.daemon = True
+                writer.start()
+
+        try:
+            # catalog.json is left out, it grows with every write and would swamp the comparison
+            run_server('routing ' + ('on' if routing == '1' else 'off'),
+                       GUNICORN + ['-c', 'gunicorn_conf.py', 'wsgi:application'],
+                       8002, total, concurrency, env=env, background=background,
+                       paths=[p for p in PATHS if p != '/catalog.json'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+BENCHMARKS = {
+    'readwrite': bench_readwrite,
+    'servers': bench_servers,
+    'csrf': bench_csrf,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print 'usage: python benchmark.py [{0}] [args...]'.format('|'.join(sorted(BENCHMARKS)))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*[int(a) for a in sys.argv[2:]])
@@ -0,0 +1,39 @@
+"""
+stateless CSRF tokens
+
+a token is `<issued timestamp in hex>.<hmac>` where the hmac (sha256, keyed with the app secret)
+covers the timestamp, the form scope (endpoint the form posts to) and a per-session key. nothing
+is stored per form, so issuing a token never mutates the session and validating it is one hmac
+"""
+import os, time, hmac, hashlib
+
+
+def new_session_key():
+    """random key identifying the session a token was issued to"""
+    return os.urandom(16).encode('hex')
+
+
+def _signature(secret, session_key, scope, issued):
+    message = '{0}|{1}|{2:x}'.format(session_key, scope, issued)
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()
+
+
+def generate_token(secret, session_key, scope, now=None):
+    """return a token for `scope` bound to `session_key`"""
+    issued = int(now or time.time())
+    return '{0:x}.{1}'.format(issued, _signature(secret, session_key, scope, issued))
+
+
+def validate_token(secret, session_key, scope, token, max_age, now=None):
+    """return True if `token` was issued for `scope` and `session_key` within the last `max_age` seconds"""
+    if not token or not session_key or '.' not in token:
+        return False
+    issued, signature = token.split('.', 1)
+    try:
+        issued = int(issued, 16)
+        signature = str(signature)
+    except ValueError:
+        return False
+    if not 0 <= int(now or time.time()) - issued <= max_age:
+        return False
+    return hmac.compare_digest(signature, _signature(secret, session_key, scope, issued))
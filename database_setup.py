@@ -1,4 +1,5 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+import json
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
@@ -104,6 +105,30 @@ class ItemImage(Base):
         }
 
 
+class Change(Base):
+    """append-only log of catalog writes, see the /changes endpoint"""
+    __tablename__ = 'change'
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String(50), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(10), nullable=False)
+    data = Column(Text)
+    changed = Column(DateTime)
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'cursor': self.id,
+            'entity': self.entity,
+            'entity_id': self.entity_id,
+            'action': self.action,
+            'data': json.loads(self.data) if self.data else None,
+            'changed': self.changed.isoformat() if self.changed else None,
+        }
+
+
 engine = create_engine('sqlite:///catalog.db')
 
 Base.metadata.create_all(engine)
@@ -0,0 +1,24 @@
+"""
+gunicorn settings for wsgi.py
+
+    CATALOG_BIND      address to listen on (default 0.0.0.0:8000)
+    CATALOG_WORKERS   number of pre-forked worker processes (default 2 * cpu + 1)
+    CATALOG_THREADS   threads per worker (default 1)
+
+graceful reload: `kill -HUP <master pid>` starts fresh workers and lets the old ones finish their
+in-flight requests. since the app is preloaded, a code change needs a full restart (or USR2 + TERM)
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('CATALOG_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('CATALOG_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('CATALOG_THREADS', 1))
+preload_app = True
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+    # open this worker's own engine now instead of on its first request
+    from application import init_db
+    init_db()
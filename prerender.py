@@ -0,0 +1,189 @@
+"""
+pre-renders the public (anonymous) catalog into a static directory
+
+    python prerender.py [--out static_site] [--workers 4] [--full] [--base-url http://localhost/]
+
+pages are rendered by the app itself, with the existing templates, across a process pool and
+written to the path of their url_for route
+    /                                        -> index.html
+    /category/1/Anaesthetics                 -> category/1/Anaesthetics/index.html
+    /category/1/Anaesthetics/item/1/...      -> category/1/Anaesthetics/item/1/.../index.html
+    /catalog.json, /recent.atom              -> catalog.json, recent.atom
+
+so nginx (or a CDN) can answer reads with `try_files $uri $uri/index.html @flask` while Flask only
+handles writes, logins and /static, /uploads can be served straight from the app folder.
+
+runs are incremental: the change log cursor of the last run is kept in <out>/.prerender.json, and
+only the pages affected by changes since then are rendered again. pages that failed to render are
+kept in the state file too and retried on the next run. pages whose url no longer exists (deleted or
+renamed) are removed. --full renders everything
+"""
+import os, sys, json, argparse, multiprocessing
+
+from werkzeug.urls import url_unquote
+from flask import url_for
+
+from application import app, db_session, init_db, dispose_db, catalog_version
+from database_setup import Category, Item, Change
+
+FEED_URLS = ('/', '/catalog.json', '/recent.atom')
+
+
+def page_path(out_dir, url):
+    """return the file a page url is written to"""
+    path = url_unquote(url).lstrip('/').encode('utf-8')
+    if url.endswith('.json') or url.endswith('.atom'):
+        return os.path.join(out_dir, path)
+    return os.path.join(out_dir, path, 'index.html')
+
+
+def current_pages():
+    """return (every page url, {category id: url}, {item id: url}, {item id: category id})"""
+    categories = dict((c.id, c) for c in db_session.query(Category))
+    category_urls = {}
+    item_urls = {}
+    item_categories = {}
+    with app.test_request_context():
+        for category in categories.values():
+            category_urls[category.id] = url_for('show_category', category_id=category.id,
+                                                 category_name=category.name)
+        for item in db_session.query(Item):
+            category = categories.get(item.category_id)
+            if category is None:
+                continue
+            item_urls[item.id] = url_for('show_item', category_id=category.id, category_name=category.name,
+                                         item_id=item.id, item_name=item.name)
+            item_categories[item.id] = category.id
+    urls = set(FEED_URLS) | set(category_urls.values()) | set(item_urls.values())
+    return urls, category_urls, item_urls, item_categories
+
+
+def affected_pages(changes, category_urls, item_urls, item_categories, previous_item_categories):
+    """return the urls to render again after the given changes"""
+    urls = set(FEED_URLS)
+    categories = set()
+    items = set()
+    for change in changes:
+        data = json.loads(change.data) if change.data else {}
+        if change.entity == 'category':
+            # every category page lists all categories in its side bar
+            categories.update(category_urls)
+            items.update(i for i, c in item_categories.items() if c == change.entity_id)
+        elif change.entity == 'subcategory':
+            categories.add(data.get('category_id'))
+        elif change.entity == 'item':
+            items.add(change.entity_id)
+            categories.add(data.get('category_id'))
+            categories.add(previous_item_categories.get(str(change.entity_id)))
+        elif change.entity == 'item_image':
+            items.add(data.get('item_id'))
+    urls.update(category_urls[c] for c in categories if c in category_urls)
+    urls.update(item_urls[i] for i in items if i in item_urls)
+    return urls
+
+
+def render_pages(args):
+    """render the given urls anonymously and write them out, return the urls that failed"""
+    out_dir, base_url, urls = args
+    init_db()
+    client = app.test_client()
+    failed = []
+    for url in urls:
+        rv = client.get(url, base_url=base_url)
+        if rv.status_code != 200:
+            failed.append(url)
+            continue
+        path = page_path(out_dir, url)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # another worker may have just created it
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        # write then rename, so the web server never serves a half written page
+        with open(path + '.tmp', 'wb') as f:
+            f.write(rv.data)
+        os.rename(path + '.tmp', path)
+    db_session.remove()
+    return failed
+
+
+def remove_pages(out_dir, urls):
+    """delete the pages of urls that no longer exist, and the directories they leave empty"""
+    for url in urls:
+        path = page_path(out_dir, url)
+        try:
+            os.remove(path)
+            os.removedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def run(out_dir, workers=4, full=False, base_url='http://localhost/'):
+    """render the catalog into out_dir, return (rendered urls, removed urls, failed urls)"""
+    init_db()
+    state_path = os.path.join(out_dir, '.prerender.json')
+    state = None
+    if not full and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    # read the cursor first, changes committed while rendering are picked up by the next run
+    cursor = catalog_version()
+    urls, category_urls, item_urls, item_categories = current_pages()
+    if state is None:
+        todo = urls
+        removed = set()
+    else:
+        changes = (db_session.query(Change)
+                   .filter(Change.id > state['cursor'])
+                   .filter(Change.id <= cursor)
+                   .order_by(Change.id)
+                   .all())
+        previous_urls = set(state['urls'])
+        # pages that failed last time are retried, apart from the change window
+        todo = (urls - previous_urls) | (urls & set(state.get('failed', [])))
+        if changes:
+            todo |= affected_pages(changes, category_urls, item_urls, item_categories, state['item_categories'])
+        removed = previous_urls - urls
+    todo = sorted(todo)
+
+    # the children open their own engines (init_db checks the pid), don't hand them the parent's
+    db_session.remove()
+    dispose_db()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    chunks = [(out_dir, base_url, todo[i::workers]) for i in xrange(workers) if todo[i::workers]]
+    pool = multiprocessing.Pool(workers)
+    try:
+        failed = [url for result in pool.map(render_pages, chunks) for url in result]
+    finally:
+        pool.close()
+        pool.join()
+    remove_pages(out_dir, removed)
+
+    # the cursor always moves on, a page that never renders must not pin every later run to the same window
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump({'cursor': cursor,
+                   'urls': sorted(urls),
+                   'failed': sorted(failed),
+                   'item_categories': item_categories}, f)
+    os.rename(state_path + '.tmp', state_path)
+    return todo, sorted(removed), failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='pre-render the public catalog into static files')
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static_site'),
+                        help='directory to write the pages to')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='rendering processes')
+    parser.add_argument('--full', action='store_true', help='render every page, not only the changed ones')
+    parser.add_argument('--base-url', default='http://localhost/', help='site url used for absolute links')
+    args = parser.parse_args(argv)
+    rendered, removed, failed = run(args.out, workers=args.workers, full=args.full, base_url=args.base_url)
+    for url in failed:
+        print 'failed    {0}'.format(url)
+    print 'rendered: {0}, removed: {1}, failed: {2}'.format(len(rendered), len(removed), len(failed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+"""
+on-demand request profiling
+
+ProfilerMiddleware wraps the whole WSGI request (routing, ORM, jinja rendering, url_for...) in
+cProfile when either
+    - the request carries a valid profile token, in the X-Profile header or the _profile query arg
+      (tokens come from /admin/profiles and expire after PROFILE_TOKEN_TIME_LIMIT seconds)
+    - it is picked by random sampling at PROFILE_SAMPLE_RATE (0 disables sampling)
+
+every profiled request is dumped as a pstats file into PROFILE_DIR, named
+    <epoch ms>-<elapsed ms>-<method>-<path>.prof
+(loadable by pstats, snakeviz, gprof2dot or flameprof). only the newest PROFILE_MAX_FILES are kept
+"""
+import os, re, time, random, pstats, cProfile
+
+from werkzeug.urls import url_decode
+
+import csrf
+
+PROFILE_SCOPE = 'profile'
+_path_re = re.compile(r'[^A-Za-z0-9]+')
+_dump_re = re.compile(r'^(\d+)-(\d+)-([^-]+)-(.*)\.prof$')
+
+
+def profile_token(app):
+    """return a token that turns on profiling for the requests carrying it"""
+    return csrf.generate_token(app.secret_key, PROFILE_SCOPE, PROFILE_SCOPE)
+
+
+class ProfilerMiddleware(object):
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+
+    def should_profile(self, environ):
+        token = environ.get('HTTP_X_PROFILE')
+        if token is None and '_profile' in environ.get('QUERY_STRING', ''):
+            token = url_decode(environ['QUERY_STRING']).get('_profile')
+        if token is not None:
+            return csrf.validate_token(self.app.secret_key, PROFILE_SCOPE, PROFILE_SCOPE, token,
+                                       self.app.config['PROFILE_TOKEN_TIME_LIMIT'])
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+        response_body = []
+
+        def run_app():
+            app_iter = self.wsgi_app(environ, start_response)
+            try:
+                response_body.extend(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.runcall(run_app)
+        self.dump(profiler, environ, start, time.time() - start)
+        return response_body
+
+    def dump(self, profiler, environ, start, elapsed):
+        directory = self.app.config['PROFILE_DIR']
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another worker may have just created it
+                if not os.path.isdir(directory):
+                    raise
+        filename = '{0:d}-{1:d}-{2}-{3}.prof'.format(int(start * 1000),
+                                                    int(elapsed * 1000),
+                                                    environ.get('REQUEST_METHOD', 'GET'),
+                                                    _path_re.sub('_', environ.get('PATH_INFO', '')).strip('_'))
+        profiler.dump_stats(os.path.join(directory, filename))
+        rotate(directory, self.app.config['PROFILE_MAX_FILES'])
+
+
+def rotate(directory, max_files):
+    """delete the oldest dumps beyond max_files"""
+    dumps = sorted(f for f in os.listdir(directory) if f.endswith('.prof'))
+    for filename in dumps[:max(len(dumps) - max_files, 0)]:
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            pass
+
+
+def list_profiles(directory, limit=20, top_functions=10):
+    """
+    return the `limit` most expensive dumps, slowest first, with their top functions by cumulative time
+
+    other workers rotate dumps away while this runs, files that vanish (or are still being written)
+    are skipped, and so are files not named like a dump
+    """
+    if not os.path.isdir(directory):
+        return []
+    candidates = []
+    for filename in os.listdir(directory):
+        match = _dump_re.match(filename)
+        if match is None:
+            continue
+        candidates.append({'filename': filename,
+                           'started': int(match.group(1)) / 1000.0,
+                           'elapsed_ms': int(match.group(2)),
+                           'method': match.group(3),
+                           'path': match.group(4)})
+    candidates.sort(key=lambda p: p['elapsed_ms'], reverse=True)
+    profiles = []
+    for profile in candidates:
+        if len(profiles) >= limit:
+            break
+        try:
+            stats = pstats.Stats(os.path.join(directory, profile['filename']))
+        except (IOError, OSError, EOFError, ValueError):
+            continue
+        stats.sort_stats('cumulative')
+        profile['functions'] = []
+        for func in stats.fcn_list[:top_functions]:
+            calls, total_calls, total_time, cumulative_time, callers = stats.stats[func]
+            profile['functions'].append({'function': '{0}:{1}({2})'.format(*func),
+                                         'calls': total_calls,
+                                         'total_ms': round(total_time * 1000, 3),
+                                         'cumulative_ms': round(cumulative_time * 1000, 3)})
+        profiles.append(profile)
+    return profiles
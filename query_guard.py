@@ -0,0 +1,48 @@
+"""
+N+1 query detection
+
+a lazy loaded relationship touched once per row (e.g. `item.category.name` in a template loop)
+runs the same SELECT over and over with different parameters. the guard counts identical SELECT
+statements per request and, when one runs more than QUERY_REPEAT_THRESHOLD times
+    - logs a warning
+    - raises RepeatedQueryError when app.config['TESTING'] is set, so the test suite fails
+
+the fix is usually to eager load the relationship (joinedload) in the db helper feeding the view
+"""
+import collections
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RepeatedQueryError(Exception):
+    pass
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and statement.lstrip()[:6].upper() == 'SELECT':
+        if 'query_counts' not in g:
+            g.query_counts = collections.Counter()
+        g.query_counts[statement] += 1
+
+
+def repeated_queries(threshold):
+    """return [(statement, count)] of the statements the current request ran more than threshold times"""
+    counts = g.get('query_counts') or {}
+    return [(statement, count) for statement, count in counts.items() if count > threshold]
+
+
+def install(app):
+    """count the queries of every request made to app"""
+    event.listen(Engine, 'before_cursor_execute', _count_query)
+
+    @app.after_request
+    def check_repeated_queries(response):
+        for statement, count in repeated_queries(app.config['QUERY_REPEAT_THRESHOLD']):
+            message = '{0} {1} ran the same query {2} times, likely a lazy load per row (N+1):\n{3}'.format(
+                request.method, request.path, count, statement)
+            if app.config['TESTING']:
+                raise RepeatedQueryError(message)
+            app.logger.warning(message)
+        return response
@@ -0,0 +1,205 @@
+"""
+server-side session storage
+
+the default flask session is a signed cookie holding the whole login_session (csrf state, oauth
+credentials, flashes), re-signed and re-sent on every modification. the interface below keeps the
+data on the server and only puts a short random session id in the cookie
+
+backends
+    MemoryStore   per-process LRU dict, only suitable for a single worker
+    SQLiteStore   sqlite file shared by all workers on the host
+
+both expire entries after `ttl` seconds and purge expired entries in batches at most once per
+`sweep_interval` seconds, piggybacked on session writes
+"""
+import os, re, time, sqlite3, threading, collections
+
+from werkzeug.datastructures import CallbackDict
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+
+_sid_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+def new_sid():
+    return os.urandom(16).encode('hex')
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """session dict that remembers its id and whether it has been changed"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """move the data to a fresh id, call when the privileges change (login) against session fixation"""
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = new_sid()
+        self.new = True
+        self.modified = True
+
+
+class MemoryStore(object):
+    """in-process LRU store, reading a session refreshes its expiry"""
+
+    def __init__(self, ttl, max_entries=10000, sweep_interval=60, sweep_batch=500):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._data.pop(sid, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            # re-insert so the OrderedDict stays in least-recently-used order
+            self._data[sid] = (time.time() + self.ttl, entry[1])
+            return entry[1]
+
+    def set(self, sid, data):
+        with self._lock:
+            self._data.pop(sid, None)
+            self._data[sid] = (time.time() + self.ttl, data)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        self.maybe_sweep()
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        self.sweep(now)
+
+    def sweep(self, now=None):
+        """drop up to sweep_batch expired entries, return how many were dropped"""
+        now = now or time.time()
+        dropped = 0
+        with self._lock:
+            # LRU order is also expiry order, so expired entries are all at the front
+            for sid, entry in self._data.iteritems():
+                if entry[0] >= now or dropped >= self.sweep_batch:
+                    break
+                dropped += 1
+            for _ in xrange(dropped):
+                self._data.popitem(last=False)
+        return dropped
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStore(object):
+    """sqlite backed store, an entry expires `ttl` seconds after it was last written"""
+
+    def __init__(self, path, ttl, sweep_interval=60, sweep_batch=500):
+        self.path = path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._local = threading.local()
+        self._last_sweep = time.time()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS session '
+                                   '(sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+        self._connection().execute('CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)')
+
+    def _connection(self):
+        # one connection per thread and per process, forked workers must not reuse the parent's handle
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, sid):
+        row = self._connection().execute('SELECT data FROM session WHERE sid = ? AND expires >= ?',
+                                         (sid, time.time())).fetchone()
+        return row and row[0]
+
+    def set(self, sid, data):
+        self._connection().execute('INSERT OR REPLACE INTO session (sid, data, expires) VALUES (?, ?, ?)',
+                                   (sid, data, time.time() + self.ttl))
+        self.maybe_sweep()
+
+    def delete(self, sid):
+        self._connection().execute('DELETE FROM session WHERE sid = ?', (sid,))
+
+    def maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        self.sweep(now)
+
+    def sweep(self, now=None):
+        """delete up to sweep_batch expired entries in one statement, return how many were deleted"""
+        cursor = self._connection().execute(
+            'DELETE FROM session WHERE sid IN (SELECT sid FROM session WHERE expires < ? LIMIT ?)',
+            (now or time.time(), self.sweep_batch))
+        return cursor.rowcount
+
+
+class ServerSessionInterface(SessionInterface):
+    """flask session interface storing session data in `store`, keyed by the id kept in the cookie"""
+
+    session_class = ServerSession
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    @classmethod
+    def from_config(cls, app):
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        if app.config['SESSION_BACKEND'] == 'memory':
+            return cls(MemoryStore(ttl, max_entries=app.config['SESSION_MEMORY_MAX_ENTRIES']))
+        if app.config['SESSION_BACKEND'] == 'sqlite':
+            return cls(SQLiteStore(app.config['SESSION_SQLITE_PATH'], ttl))
+        raise ValueError('unknown session backend {0}'.format(app.config['SESSION_BACKEND']))
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid and _sid_re.match(sid):
+            data = self.store.get(sid)
+            if data is not None:
+                return self.session_class(self.serializer.loads(data), sid=sid)
+        return self.session_class(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid is not None:
+            # regenerated, the old id must not reach the data any more
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if session.modified:
+            self.store.set(session.sid, self.serializer.dumps(dict(session)))
+        # the id only changes on regenerate(), the cookie is sent then (or to extend a permanent session)
+        if session.new or (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app))
@@ -1,5 +1,14 @@
-from application import app
-import unittest
+import application
+from application import app, db_session, get_item
+from query_guard import repeated_queries
+from StringIO import StringIO
+from werkzeug.contrib.fixers import ProxyFix
+from session_store import MemoryStore, ServerSessionInterface
+import csrf
+import admission
+import upload_gc
+import prerender
+import unittest, time, os, re, json, shutil, sqlite3, tempfile
 
 app.config['TESTING'] = True
 
@@ -38,6 +47,364 @@ class FlaskTestCase(unittest.TestCase):
         rv = self.logout()
         assert 'You need to log in first' in rv.data
 
+    # ensure the batched subcategory api answers for several categories and revalidates by ETag
+    def test_subcategories_batch(self):
+        rv = self.app.get('/subcategories.json?category_ids=1,2')
+        self.assertEqual(sorted(json.loads(rv.data)['subcategories']), ['1', '2'])
+        rv = self.app.get('/subcategories.json?category_ids=1,2', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+    # ensure the public pages stay free of N+1 lazy loads (TESTING turns repeats into errors)
+    def test_no_repeated_queries(self):
+        for url in ('/', '/recent.atom', '/catalog.json', '/category/1/Anaesthetics',
+                    '/category/1/Anaesthetics/item/1/halothane'):
+            self.assertEqual(self.app.get(url).status_code, 200)
+        with app.test_request_context('/'):
+            for item_id in (1, 2, 3):
+                get_item(item_id)
+            self.assertEqual(len(repeated_queries(app.config['QUERY_REPEAT_THRESHOLD'])), 1)
+            db_session.remove()
+
+    # ensure GET requests read through the query_only engine and other methods use the primary
+    def test_read_write_routing(self):
+        self.app.get('/')
+        for method, bind in (('GET', application.read_engine), ('POST', application.engine)):
+            with app.test_request_context('/', method=method):
+                app.preprocess_request()
+                self.assertIs(db_session.get_bind(), bind)
+                db_session.remove()
+        self.assertEqual(application.read_engine.execute('PRAGMA query_only').scalar(), 1)
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(app.config)
+        self.lock_dir = tempfile.mkdtemp()
+        app.config['ADMISSION_LOCK_DIR'] = self.lock_dir
+        self.app = app.test_client()
+        # a client address of its own, so the buckets used here don't throttle other tests
+        self.environ = {'REMOTE_ADDR': '10.0.0.1'}
+
+    def tearDown(self):
+        app.config.update(self.config)
+        shutil.rmtree(self.lock_dir)
+
+    # ensure a client over its rate is shed with 429 and Retry-After, and counted
+    def test_rate_limit(self):
+        app.config['ADMISSION_LIMITS'] = {'recent_feed': {'rate': 0.1, 'burst': 2}}
+        rejected = application.admission_control.metrics().get('recent_feed', {}).get('rejected_rate', 0)
+        statuses = [self.app.get('/recent.atom', environ_base=self.environ).status_code for _ in xrange(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        rv = self.app.get('/recent.atom', environ_base=self.environ)
+        self.assertEqual(rv.headers['Retry-After'], '10')
+        self.assertEqual(application.admission_control.metrics()['recent_feed']['rejected_rate'], rejected + 2)
+
+    # ensure clients behind a trusted proxy get a bucket each, keyed on their X-Forwarded-For address
+    def test_rate_limit_behind_proxy(self):
+        app.config['ADMISSION_LIMITS'] = {'recent_feed': {'rate': 0.1, 'burst': 1}}
+        wsgi_app = app.wsgi_app
+        app.wsgi_app = ProxyFix(wsgi_app, num_proxies=1)
+        try:
+            statuses = [self.app.get('/recent.atom', environ_base=self.environ,
+                                     headers={'X-Forwarded-For': client}).status_code
+                        for client in ('192.0.2.1', '192.0.2.2', '192.0.2.1')]
+        finally:
+            app.wsgi_app = wsgi_app
+        self.assertEqual(statuses, [200, 200, 429])
+
+    # ensure logged in users are told apart by account id, not by their display name
+    def test_rate_limit_per_account(self):
+        app.config['ADMISSION_LIMITS'] = {'recent_feed': {'rate': 0.1, 'burst': 1}}
+        statuses = []
+        for user_id in ('google:1', 'google:2', 'google:1'):
+            with self.app.session_transaction() as session:
+                session['user'] = 'Same Name'
+                session['user_id'] = user_id
+            statuses.append(self.app.get('/recent.atom', environ_base=self.environ).status_code)
+        self.assertEqual(statuses, [200, 200, 429])
+
+    # ensure a request finding every slot taken, by any worker, is shed with 503 once its queue timeout runs out
+    def test_concurrency_limit(self):
+        app.config['ADMISSION_LIMITS'] = {'api_changes': {'concurrency': 1, 'queue_timeout': 0.01}}
+        self.assertEqual(self.app.get('/changes', environ_base=self.environ).status_code, 200)
+        # another worker process holding the only slot
+        slot_lock = admission.SlotLock(self.lock_dir, 'api_changes', 1)
+        slot = slot_lock.try_acquire()
+        try:
+            rv = self.app.get('/changes', environ_base=self.environ)
+        finally:
+            slot_lock.release(slot)
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '1')
+        self.assertEqual(self.app.get('/changes', environ_base=self.environ).status_code, 200)
+
+
+class SessionStoreTestCase(unittest.TestCase):
+    # ensure the in-memory store evicts least recently used entries and expires old ones
+    def test_memory_store(self):
+        store = MemoryStore(ttl=60, max_entries=2)
+        store.set('a', '1')
+        store.set('b', '2')
+        store.get('a')
+        store.set('c', '3')
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('a'), '1')
+        self.assertEqual(store.sweep(time.time() + 120), 2)
+        self.assertEqual(len(store), 0)
+
+    # ensure the server-side session only sends the session id cookie once
+    def test_server_session(self):
+        default_interface = app.session_interface
+        app.session_interface = ServerSessionInterface(MemoryStore(ttl=60))
+        try:
+            client = app.test_client()
+            rv = client.get('/login')
+            cookie = rv.headers.get('Set-Cookie')
+            self.assertRegexpMatches(cookie, r'^session=[0-9a-f]{32};')
+            rv = client.get('/login')
+            self.assertEqual(rv.headers.get('Set-Cookie'), None)
+        finally:
+            app.session_interface = default_interface
+
+    # ensure logging in moves the session to a new id and the old one is dropped (session fixation)
+    def test_server_session_login(self):
+        default_interface = app.session_interface
+        store = MemoryStore(ttl=60)
+        app.session_interface = ServerSessionInterface(store)
+        try:
+            client = app.test_client()
+            rv = client.get('/login')
+            old_sid = re.search(r'^session=([0-9a-f]{32});', rv.headers['Set-Cookie']).group(1)
+            state = re.search(r'name="state" value="([^"]+)"', rv.data).group(1)
+            rv = client.post('/login', data={'username': 'admin', 'password': 'admin', 'state': state})
+            new_sid = re.search(r'^session=([0-9a-f]{32});', rv.headers['Set-Cookie']).group(1)
+            self.assertNotEqual(new_sid, old_sid)
+            self.assertEqual(store.get(old_sid), None)
+            self.assertIn('"user"', store.get(new_sid))
+        finally:
+            app.session_interface = default_interface
+
+
+class CSRFTestCase(unittest.TestCase):
+    # ensure tokens only validate for the scope, session and time window they were issued for
+    def test_token(self):
+        token = csrf.generate_token('secret', 'key', 'edit_item', now=1000)
+        self.assertTrue(csrf.validate_token('secret', 'key', 'edit_item', token, 60, now=1030))
+        self.assertFalse(csrf.validate_token('secret', 'key', 'delete_item', token, 60, now=1030))
+        self.assertFalse(csrf.validate_token('secret', 'other key', 'edit_item', token, 60, now=1030))
+        self.assertFalse(csrf.validate_token('secret', 'key', 'edit_item', token, 60, now=1061))
+        self.assertFalse(csrf.validate_token('secret', 'key', 'edit_item', 'garbage', 60, now=1030))
+
+
+class ItemWriteTestCase(unittest.TestCase):
+    # writes go to a copy of the database and a temporary upload folder
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        shutil.copy('catalog.db', self.tmp_dir)
+        self.config = dict(app.config)
+        app.config['DATABASE_URI'] = 'sqlite:///' + os.path.join(self.tmp_dir, 'catalog.db')
+        self.upload_dir = os.path.join(self.tmp_dir, 'uploads')
+        os.mkdir(self.upload_dir)
+        app.config['UPLOAD_FOLDER'] = self.upload_dir
+        app.config['ADMISSION_LIMITS'] = {}
+        self.app = app.test_client()
+        rv = self.app.get('/login')
+        self.app.post('/login', data=dict(username='admin', password='admin', state=self.state(rv)))
+
+    def tearDown(self):
+        db_session.remove()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmp_dir)
+
+    def state(self, rv):
+        return re.search(r'name="state" value="([^"]+)"', rv.data).group(1)
+
+    # ensure a batch is created in one go, with its images moved into place
+    def test_batch_items(self):
+        state = json.loads(self.app.get('/items/batch').data)['state']
+        items = [{'name': 'batch one', 'category': 1}, {'name': 'batch two', 'category': 1, 'subcategory': ''}]
+        rv = self.app.post('/items/batch', data={'state': state,
+                                                 'items': json.dumps(items),
+                                                 'image-1': (StringIO('img'), 'two.png')})
+        self.assertEqual(rv.status_code, 201)
+        created = json.loads(rv.data)['items']
+        self.assertEqual([i['name'] for i in created], ['batch one', 'batch two'])
+        self.assertEqual(sorted(os.listdir(self.upload_dir)),
+                         ['{0}-two.png'.format(created[1]['id'])])
+
+    # ensure nothing is written when any item in the batch is invalid
+    def test_batch_items_invalid(self):
+        state = json.loads(self.app.get('/items/batch').data)['state']
+        items = [{'name': 'batch one', 'category': 1}, {'name': 'batch two', 'category': 9999}]
+        rv = self.app.post('/items/batch', data={'state': state, 'items': json.dumps(items)})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(json.loads(rv.data)['errors'], ['item 1: category is not found'])
+        rv = self.app.get('/')
+        self.assertNotIn('batch one', rv.data)
+
+    # ensure replacing an item's image swaps the file and leaves no staged files behind
+    def test_edit_item_image(self):
+        rv = self.app.get('/item/new')
+        rv = self.app.post('/item/new', data={'state': self.state(rv), 'name': 'imaged', 'category': '1',
+                                              'image': (StringIO('old'), 'old.png')})
+        item_id = re.search(r'/item/(\d+)/imaged', rv.headers['Location']).group(1)
+        rv = self.app.get('/item/{0}/imaged/edit'.format(item_id))
+        self.app.post('/item/{0}/imaged/edit'.format(item_id),
+                      data={'state': self.state(rv), 'category': '1', 'image': (StringIO('new'), 'new.png')})
+        self.assertEqual(sorted(os.listdir(self.upload_dir)),
+                         ['{0}-new.png'.format(item_id)])
+
+
+    # ensure deleting an item whose image file is already gone still works
+    def test_delete_item_missing_image(self):
+        rv = self.app.get('/item/new')
+        rv = self.app.post('/item/new', data={'state': self.state(rv), 'name': 'doomed', 'category': '1',
+                                              'image': (StringIO('img'), 'doomed.png')})
+        item_id = re.search(r'/item/(\d+)/doomed', rv.headers['Location']).group(1)
+        os.remove(os.path.join(self.upload_dir, '{0}-doomed.png'.format(item_id)))
+        rv = self.app.get('/item/{0}/doomed/edit'.format(item_id))
+        state = re.search(r'id="deleteItemForm">\s*<input type="hidden" name="state" value="([^"]+)"',
+                          rv.data).group(1)
+        rv = self.app.post('/item/{0}/doomed/delete'.format(item_id), data={'state': state},
+                           follow_redirects=True)
+        self.assertIn('Item doomed deleted!', rv.data)
+
+    # ensure the upload reconciliation finds and removes orphan files and dangling rows
+    def test_upload_gc(self):
+        open(os.path.join(self.upload_dir, '999-orphan.png'), 'w').close()
+        state_path = os.path.join(self.tmp_dir, 'gc.db')
+        # the temporary upload folder is empty, so every existing image row is dangling
+        report = upload_gc.run(self.upload_dir, state_path, delete=True, grace=-1)
+        self.assertTrue(report['dangling'] > 0)
+        self.assertEqual(report['dangling'], report['dangling_removed'])
+        self.assertEqual(report['orphans_removed'], 1)
+        report = upload_gc.run(self.upload_dir, state_path)
+        self.assertEqual((report['orphans'], report['dangling']), (0, 0))
+        # hashes are recorded once, files that are gone are forgotten
+        open(os.path.join(self.upload_dir, 'new.png'), 'w').close()
+        self.assertEqual(upload_gc.run(self.upload_dir, state_path, batch=1)['hashed'], 1)
+        self.assertEqual(upload_gc.run(self.upload_dir, state_path, batch=1)['hashed'], 0)
+        os.remove(os.path.join(self.upload_dir, 'new.png'))
+        upload_gc.run(self.upload_dir, state_path)
+        conn = sqlite3.connect(state_path)
+        self.assertEqual(conn.execute('SELECT count(*) FROM file_hash').fetchone()[0], 0)
+        conn.close()
+
+    # ensure a subdirectory in the upload folder is skipped instead of aborting the pass
+    def test_upload_gc_subdirectory(self):
+        os.mkdir(os.path.join(self.upload_dir, 'nested'))
+        report = upload_gc.run(self.upload_dir, os.path.join(self.tmp_dir, 'gc.db'), grace=-1)
+        self.assertEqual((report['files'], report['orphans']), (0, 0))
+
+    # ensure a file removed by the app between its stat and its hashing counts as gone
+    def test_upload_gc_vanishing_file(self):
+        open(os.path.join(self.upload_dir, 'gone.png'), 'w').close()
+        file_hash = upload_gc.file_hash
+
+        def remove_then_hash(path):
+            os.remove(path)
+            return file_hash(path)
+
+        upload_gc.file_hash = remove_then_hash
+        try:
+            report = upload_gc.run(self.upload_dir, os.path.join(self.tmp_dir, 'gc.db'), grace=-1)
+        finally:
+            upload_gc.file_hash = file_hash
+        self.assertEqual((report['files'], report['hashed'], report['orphans']), (0, 0, 0))
+
+    # ensure the static export renders every public page, then only the pages touched by new writes
+    def test_prerender(self):
+        out_dir = os.path.join(self.tmp_dir, 'site')
+        rendered, removed, failed = prerender.run(out_dir, workers=2)
+        self.assertEqual(failed, [])
+        self.assertTrue(os.path.exists(os.path.join(out_dir, 'category', '1', 'Anaesthetics', 'index.html')))
+        self.assertEqual(prerender.run(out_dir, workers=2), ([], [], []))
+        state = json.loads(self.app.get('/items/batch').data)['state']
+        self.app.post('/items/batch', data={'state': state, 'items': json.dumps([{'name': 'static', 'category': 1}])})
+        rendered, removed, failed = prerender.run(out_dir, workers=2)
+        self.assertEqual(len(rendered), 5)  # home, catalog.json, recent.atom, category 1 and the new item
+        self.assertIn('/category/1/Anaesthetics', rendered)
+        # a page that cannot render is retried on every run, without holding the change cursor back
+        state = json.loads(self.app.get('/items/batch').data)['state']
+        items = json.dumps([{'name': '../../../../x', 'category': 1}])  # its url_for path is a 404
+        self.app.post('/items/batch', data={'state': state, 'items': items})
+        rendered, removed, failed = prerender.run(out_dir, workers=2)
+        self.assertEqual(len(failed), 1)
+        with open(os.path.join(out_dir, '.prerender.json')) as f:
+            self.assertEqual(json.load(f)['cursor'], application.catalog_version())
+        self.assertEqual(prerender.run(out_dir, workers=2), (failed, [], failed))
+
+    # ensure a request carrying the profile token is dumped and listed by the admin endpoint
+    def test_profiling(self):
+        app.config['PROFILE_DIR'] = os.path.join(self.tmp_dir, 'profiles')
+        token = json.loads(self.app.get('/admin/profiles').data)['token']
+        self.app.get('/', headers={'X-Profile': token})
+        self.app.get('/', headers={'X-Profile': 'forged.token'})
+        # a dump rotated away while listing (a dangling link), a half written one and a stray file are skipped
+        os.symlink(os.path.join(self.tmp_dir, 'gone'), os.path.join(app.config['PROFILE_DIR'], '1-900-GET-gone.prof'))
+        open(os.path.join(app.config['PROFILE_DIR'], '2-800-GET-partial.prof'), 'w').close()
+        open(os.path.join(app.config['PROFILE_DIR'], 'notes-on-slow-pages.prof'), 'w').close()
+        profiles = json.loads(self.app.get('/admin/profiles').data)['profiles']
+        self.assertEqual([(p['method'], p['path']) for p in profiles], [('GET', '')])
+        self.assertTrue(profiles[0]['functions'])
+
+    # ensure a database from before the change log gets its table on startup
+    def test_missing_tables_created(self):
+        path = os.path.join(self.tmp_dir, 'old.db')
+        shutil.copy('catalog.db', path)
+        conn = sqlite3.connect(path)
+        conn.execute('DROP TABLE change')
+        conn.close()
+        app.config['DATABASE_URI'] = 'sqlite:///' + path
+        self.assertEqual(self.app.get('/subcategories.json').status_code, 200)
+        state = json.loads(self.app.get('/items/batch').data)['state']
+        rv = self.app.post('/items/batch', data={'state': state, 'items': json.dumps([{'name': 'x', 'category': 1}])})
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(len(json.loads(self.app.get('/changes').data)['changes']), 1)
+
+    # ensure writes show up in the change feed, paginated by cursor
+    def test_changes(self):
+        cursor = json.loads(self.app.get('/changes?since=0&limit=1000').data)['cursor']
+        state = json.loads(self.app.get('/items/batch').data)['state']
+        items = [{'name': 'feed one', 'category': 1}, {'name': 'feed two', 'category': 1}]
+        self.app.post('/items/batch', data={'state': state, 'items': json.dumps(items)})
+        rv = json.loads(self.app.get('/changes?since={0}&limit=1'.format(cursor)).data)
+        self.assertTrue(rv['has_more'])
+        self.assertEqual(rv['changes'][0]['action'], 'create')
+        self.assertEqual(rv['changes'][0]['data']['name'], 'feed one')
+        rv = json.loads(self.app.get('/changes?since={0}'.format(rv['cursor'])).data)
+        self.assertFalse(rv['has_more'])
+        self.assertEqual([c['data']['name'] for c in rv['changes']], ['feed two'])
+
+    # ensure an edit logs one change with its committed state, not one per autoflush
+    def test_changes_per_commit(self):
+        cursor = json.loads(self.app.get('/changes?since=0&limit=1000').data)['cursor']
+        rv = self.app.get('/item/1/Halothane/edit')
+        self.app.post('/item/1/Halothane/edit', data={'state': self.state(rv), 'name': 'Halothane 2',
+                                                      'category': '1', 'subcategory': '2'})
+        changes = json.loads(self.app.get('/changes?since={0}'.format(cursor)).data)['changes']
+        self.assertEqual([(c['action'], c['data']['name'], c['data']['subcategory_id']) for c in changes],
+                         [('update', 'Halothane 2', 2)])
+
+    # ensure a row created then updated stays a create without turning other updates into creates
+    def test_changes_mixed_actions(self):
+        cursor = json.loads(self.app.get('/changes?since=0&limit=1000').data)['cursor']
+        with app.test_request_context('/', method='POST'):
+            app.preprocess_request()
+            item = get_item(1)
+            category = application.Category(name='mixed')
+            db_session.add(category)
+            db_session.flush()
+            # both updates land in the same flush
+            category.name = 'mixed 2'
+            item.name = 'Halothane 3'
+            db_session.commit()
+            category_id = category.id
+            db_session.remove()
+        changes = json.loads(self.app.get('/changes?since={0}'.format(cursor)).data)['changes']
+        self.assertEqual([(c['entity'], c['entity_id'], c['action'], c['data']['name']) for c in changes],
+                         [('category', category_id, 'create', 'mixed 2'), ('item', 1, 'update', 'Halothane 3')])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,223 @@
+"""
+reconciles the upload folder with the item_image table
+
+    python upload_gc.py [--delete] [--verify] [--workers 8] [--batch 1000] [--grace 3600] [--state FILE]
+
+reports (and with --delete, removes)
+    orphans     files in the upload folder no ItemImage row refers to
+                (including staged uploads left behind by a crashed process)
+    dangling    ItemImage rows whose file is missing
+
+the upload folder is listed before the table is read, so a file committed while the job runs is
+never taken for an orphan, and files younger than --grace seconds are left alone. dangling rows are
+re-checked on disk before being reported.
+
+files are stat'ed and hashed (sha256) on a thread pool, batch by batch, in filename order. hashes are
+kept in a small sqlite file (--state) next to the progress cursor, and each batch only writes its own
+rows and the cursor in one transaction, so
+    - the job is incremental: only new or changed (size / mtime) files are hashed again, unless
+      --verify re-hashes everything and reports files whose content changed underneath them
+    - the job is resumable: an interrupted run continues after the last finished batch
+
+memory: the hash manifest stays on disk, but the folder listing and the set of referenced filenames
+are held in memory, roughly 100 bytes per file and per ItemImage row
+"""
+import os, sys, stat, time, sqlite3, hashlib, argparse
+from multiprocessing.pool import ThreadPool
+
+from application import app, init_db, db_session
+from database_setup import ItemImage
+
+STAGED_PREFIX = '.staged-'
+
+
+class Manifest(object):
+    """recorded file hashes and the progress cursor, in a sqlite file updated one batch at a time"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=10)
+        # filenames are byte strings, as listed, and compare the same way in sqlite and python
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS file_hash (filename TEXT PRIMARY KEY, '
+                              'size INTEGER NOT NULL, mtime REAL NOT NULL, sha256 TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS progress (id INTEGER PRIMARY KEY, file_cursor TEXT)')
+            self.conn.execute('INSERT OR IGNORE INTO progress (id, file_cursor) VALUES (0, NULL)')
+
+    def file_cursor(self):
+        """return the last filename of the last finished batch, None when no pass is in progress"""
+        return self.conn.execute('SELECT file_cursor FROM progress WHERE id = 0').fetchone()[0]
+
+    def known(self, after, last):
+        """return {filename: {'size', 'mtime', 'sha256'}} for the recorded files in (after, last]"""
+        rows = self.conn.execute('SELECT filename, size, mtime, sha256 FROM file_hash '
+                                 'WHERE filename > ? AND filename <= ?', (after or '', last))
+        return dict((f, {'size': size, 'mtime': mtime, 'sha256': sha256}) for f, size, mtime, sha256 in rows)
+
+    def save_batch(self, hashes, gone, cursor):
+        """record the batch's new hashes, forget its gone files and move the cursor, all or nothing"""
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO file_hash (filename, size, mtime, sha256) '
+                                  'VALUES (?, ?, ?, ?)',
+                                  [(f, h['size'], h['mtime'], h['sha256']) for f, h in hashes.items()])
+            self.conn.executemany('DELETE FROM file_hash WHERE filename = ?', [(f,) for f in gone])
+            self.conn.execute('UPDATE progress SET file_cursor = ? WHERE id = 0', (cursor,))
+
+    def finish(self, last):
+        """end the pass: forget the files after the last one listed and start over next time"""
+        with self.conn:
+            self.conn.execute('DELETE FROM file_hash WHERE filename > ?', (last or '',))
+            self.conn.execute('UPDATE progress SET file_cursor = NULL WHERE id = 0')
+
+    def close(self):
+        self.conn.close()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def inspect_file(args):
+    """
+    return (filename, size, mtime, sha256 or None when the known hash is still valid) for a file,
+    or (filename, None, None, None) when it is gone or not a regular file
+    """
+    directory, filename, known, verify = args
+    path = os.path.join(directory, filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return filename, None, None, None
+    if not stat.S_ISREG(st.st_mode):
+        return filename, None, None, None
+    if known and not verify and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+        return filename, st.st_size, st.st_mtime, None
+    try:
+        digest = file_hash(path)
+    except (IOError, OSError):
+        # removed by the app between the stat and the open
+        return filename, None, None, None
+    return filename, st.st_size, st.st_mtime, digest
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+def referenced_filenames(batch):
+    """stream every ItemImage filename, return them as a set (held in memory, see the module docstring)"""
+    return set(filename for filename, in db_session.query(ItemImage.filename).yield_per(batch))
+
+
+def find_dangling(directory, files, batch, pool):
+    """stream ItemImage rows and return the ids of those whose file is missing"""
+    candidates = []
+    for image in db_session.query(ItemImage).order_by(ItemImage.id).yield_per(batch):
+        if image.filename not in files:
+            candidates.append((image.id, image.filename))
+    # the row may have been committed after the folder was listed, check the disk again
+    exists = pool.map(os.path.exists, [os.path.join(directory, f) for i, f in candidates])
+    return [(image_id, filename) for (image_id, filename), found in zip(candidates, exists) if not found]
+
+
+def delete_rows(image_ids, batch):
+    """delete ItemImage rows, one transaction per batch"""
+    for start in xrange(0, len(image_ids), batch):
+        chunk = image_ids[start:start + batch]
+        for image in db_session.query(ItemImage).filter(ItemImage.id.in_(chunk)):
+            db_session.delete(image)
+        db_session.commit()
+
+
+def run(directory, state_path, delete=False, verify=False, workers=8, batch=1000, grace=3600):
+    manifest = Manifest(state_path)
+    pool = ThreadPool(workers)
+    now = time.time()
+    report = {'orphans': 0, 'orphans_removed': 0, 'dangling': 0, 'dangling_removed': 0,
+              'hashed': 0, 'changed': 0, 'files': 0}
+
+    # 1. list the folder first, then read the table (see module docstring)
+    files = sorted(f for f in os.listdir(directory) if not f.startswith('.') or f.startswith(STAGED_PREFIX))
+    references = referenced_filenames(batch)
+
+    # 2. files, in batches, resuming after the last finished one. a batch covers the filenames after
+    # the previous batch's last one up to its own last, recorded files in that range it did not list are gone
+    cursor = manifest.file_cursor()
+    todo = [f for f in files if cursor is None or f > cursor]
+    for start in xrange(0, len(todo), batch):
+        chunk = todo[start:start + batch]
+        known = manifest.known(cursor, chunk[-1])
+        results = pool.map(inspect_file, [(directory, f, known.get(f), verify) for f in chunk])
+        hashes = {}
+        gone = set(known) - set(chunk)
+        orphans = []
+        for filename, size, mtime, digest in results:
+            if size is None:
+                gone.add(filename)
+                continue
+            report['files'] += 1
+            if digest is not None:
+                report['hashed'] += 1
+                previous = known.get(filename)
+                if (previous and previous['size'] == size and previous['mtime'] == mtime
+                        and previous['sha256'] != digest):
+                    report['changed'] += 1
+                    print 'changed   {0} (content differs from the recorded hash)'.format(filename)
+                hashes[filename] = {'size': size, 'mtime': mtime, 'sha256': digest}
+            if filename not in references and now - mtime > grace:
+                orphans.append(filename)
+                print 'orphan    {0}'.format(filename)
+        report['orphans'] += len(orphans)
+        if delete and orphans:
+            removed = pool.map(remove_file, [os.path.join(directory, f) for f in orphans])
+            report['orphans_removed'] += sum(removed)
+            for filename, ok in zip(orphans, removed):
+                if ok:
+                    hashes.pop(filename, None)
+                    gone.add(filename)
+        cursor = chunk[-1]
+        manifest.save_batch(hashes, gone, cursor)
+
+    # 3. rows whose file is gone
+    dangling = find_dangling(directory, set(files), batch, pool)
+    for image_id, filename in dangling:
+        print 'dangling  item_image {0} -> {1}'.format(image_id, filename)
+    report['dangling'] = len(dangling)
+    if delete and dangling:
+        delete_rows([image_id for image_id, filename in dangling], batch)
+        report['dangling_removed'] = len(dangling)
+
+    # finished a full pass, forget files past the last one listed and start over next time
+    manifest.finish(cursor)
+    manifest.close()
+    pool.close()
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='reconcile the upload folder with the item_image table')
+    parser.add_argument('--delete', action='store_true', help='remove orphan files and dangling rows')
+    parser.add_argument('--verify', action='store_true', help='re-hash every file, not only new / changed ones')
+    parser.add_argument('--workers', type=int, default=8, help='threads used to stat, hash and delete files')
+    parser.add_argument('--batch', type=int, default=1000, help='files / rows per batch')
+    parser.add_argument('--grace', type=int, default=3600, help='ignore orphan files younger than this (seconds)')
+    parser.add_argument('--state', default=os.path.join(app.config['UPLOAD_FOLDER'], '.upload_gc.db'),
+                        help='progress and hash manifest (sqlite) file')
+    args = parser.parse_args(argv)
+    init_db()
+    report = run(app.config['UPLOAD_FOLDER'], args.state, delete=args.delete, verify=args.verify,
+                 workers=args.workers, batch=args.batch, grace=args.grace)
+    print ', '.join('{0}: {1}'.format(k, report[k]) for k in sorted(report))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,27 @@
+"""
+production WSGI entry point
+
+    gunicorn -c gunicorn_conf.py wsgi:application
+
+unlike `python application.py` this never turns on the debugger / reloader. the app is imported
+and warmed up once in the master, then forked into workers which lazily open their own database
+engine (see application.init_db)
+"""
+from application import app, db_session, dispose_db
+
+application = app
+
+
+def warm_up():
+    """compile every template and serve the public pages once so workers fork from a primed process"""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    client = app.test_client()
+    for url in ('/', '/catalog.json', '/recent.atom', '/login'):
+        client.get(url)
+    # drop the master's db handles, each worker re-creates its own engine after fork
+    db_session.remove()
+    dispose_db()
+
+
+warm_up()